@@ -1,30 +1,66 @@
 import argparse
 import asyncio
 import base64
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
 from functools import cache
-import glob
-import json
+from itertools import repeat
 import os
 import pprint
 import re
 import shutil
+import sqlite3
 import sys
-from typing import Dict, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from urllib.parse import quote
 
-from azure.identity import InteractiveBrowserCredential
-import dateparser
 from jinja2 import Environment, FileSystemLoader
-from kiota_abstractions.native_response_handler import NativeResponseHandler
-from kiota_http.middleware.options import ResponseHandlerOption
-from msgraph import GraphServiceClient
-from msgraph.generated.chats.chats_request_builder import ChatsRequestBuilder
-from msgraph.generated.chats.item.messages.messages_request_builder import MessagesRequestBuilder
+import orjson
 import pytz
 
+try:
+    # optional, but much faster at parsing timestamps than datetime.fromisoformat
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+
+# the MS Graph SDK is slow to import and only needed for downloading, so those
+# imports happen inside the functions that use it. this keeps generate_html fast.
+if TYPE_CHECKING:
+    from msgraph import GraphServiceClient
+
 client_id = os.getenv("CLIENT_ID")
 
 filename_size_limit = 255
 
+local_tz = pytz.timezone("America/Los_Angeles")
+
+# cap on the number of chats downloaded concurrently
+max_concurrent_downloads = 64
+
+# the $batch endpoint accepts at most 20 requests at a time
+batch_size_limit = 20
+max_batch_attempts = 3
+# must be a multiple of 4 so each chunk of base64 decodes on its own
+base64_chunk_size = 64 * 1024
+
+# threads used to read hosted content files when rendering, per process
+max_concurrent_reads = 8
+# msgs rendered at a time; only one chunk's hosted content files are held in memory
+render_chunk_size = 100
+
+# fractional seconds in a timestamp
+iso_fraction_re = re.compile(r"\.(\d+)")
+# loosey-goosey matching here :(
+src_re = re.compile('src="([^"]+)"')
+# emojis, attachments, and image srcs in a msg body, matched in a single pass
+message_body_re = re.compile(
+    '<emoji[^>]*?alt="(?P<alt>[^"]+)"[^>]*></emoji>'
+    '|<attachment id="(?P<attachment_id>[^"]+)"></attachment>'
+    '|src="(?P<src>[^"]+)"'
+)
+
 
 def makedir(path):
     """basically mkdir -p"""
@@ -39,11 +75,32 @@ def get_jinja_env():
     return jinja_env
 
 
+@cache
+def get_read_executor() -> ThreadPoolExecutor:
+    """thread pool shared by all the chats rendered in this process"""
+    return ThreadPoolExecutor(max_workers=max_concurrent_reads)
+
+
+@cache
+def get_chat_template():
+    return get_jinja_env().get_template("chat.jinja")
+
+
+@cache
+def get_index_template():
+    return get_jinja_env().get_template("index.jinja")
+
+
 def localdt(value: str, format="%m/%d/%Y %I:%M %p %Z"):
-    """parse a date string into a datetime object, localize it, and format it for display"""
-    tz = pytz.timezone("America/Los_Angeles")
-    dt = dateparser.parse(value)
-    local_dt = dt.astimezone(tz)
+    """parse an ISO 8601 date string into a datetime object, localize it, and format it for display"""
+    if ciso8601:
+        dt = ciso8601.parse_datetime(value)
+    else:
+        # before python 3.11, fromisoformat() only accepts exactly 3 or 6 fractional digits
+        # and no "Z", but Graph timestamps can have anywhere from 0 to 7
+        value = iso_fraction_re.sub(lambda m: "." + m.group(1)[:6].ljust(6, "0"), value, count=1)
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    local_dt = dt.astimezone(local_tz)
     return local_dt.strftime(format)
 
 
@@ -75,13 +132,56 @@ def get_hosted_content_filename(msg_id, hosted_content_id):
 
 def get_hosted_content_id(attachment: dict) -> str:
     """extract the hosted_content_id from the Attachment dict record"""
+    # the id is needed both when reading the hosted contents and when rendering,
+    # so cache it on the record instead of parsing the content twice
+    if "_hosted_content_id" in attachment:
+        return attachment["_hosted_content_id"]
     # it's stupid that I have to parse this. codeSnippetUrl already is the complete URL
     # but I can't figure out how to make a request to it directly using the client object
-    content = json.loads(attachment["content"])
+    content = orjson.loads(attachment["content"])
     hosted_content_id = content["codeSnippetUrl"].split("/")[-2]
+    attachment["_hosted_content_id"] = hosted_content_id
     return hosted_content_id
 
 
+def open_messages_db(chat_dir: str) -> sqlite3.Connection:
+    """
+    open the sqlite db that stores all the messages for a chat, creating it if needed.
+
+    older versions of this script stored each msg in its own msg_<id>.json file;
+    those are imported when the db is set up.
+    """
+    conn = sqlite3.connect(os.path.join(chat_dir, "messages.sqlite"))
+    if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+        # create the table, import the legacy files, and mark the db as set up in one
+        # transaction, so a failed import gets retried instead of leaving an empty db behind
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS msgs (id TEXT PRIMARY KEY, last_modified TEXT, last_edited TEXT, json BLOB)"
+            )
+            for entry in os.scandir(chat_dir):
+                if not (entry.name.startswith("msg_") and entry.name.endswith(".json")):
+                    continue
+                with open(entry.path, "rb") as f:
+                    msg = orjson.loads(f.read())
+                # never overwrite a msg that's already in the db with an older copy
+                conn.execute(
+                    "INSERT OR IGNORE INTO msgs (id, last_modified, last_edited, json) VALUES (?, ?, ?, ?)",
+                    (msg["id"], msg["lastModifiedDateTime"], msg["lastEditedDateTime"], orjson.dumps(msg)),
+                )
+            conn.execute("PRAGMA user_version = 1")
+    return conn
+
+
+def save_msg_to_db(conn: sqlite3.Connection, msg: Dict):
+    """insert or replace a msg in a chat's messages db"""
+    conn.execute(
+        "INSERT OR REPLACE INTO msgs (id, last_modified, last_edited, json) VALUES (?, ?, ?, ?)",
+        (msg["id"], msg["lastModifiedDateTime"], msg["lastEditedDateTime"], orjson.dumps(msg)),
+    )
+
+
 async def fetch_all_for_request(getable, request_config):
     """
     returns an iterator over the dict records returned from a request
@@ -100,65 +200,138 @@ async def fetch_all_for_request(getable, request_config):
         if getable_:
             response = await getable_.get(request_configuration=request_config)
             if response:
-                results = response.json()
+                results = orjson.loads(response.content)
                 for result in results["value"]:
                     yield result
 
 
-async def download_hosted_content(client, chat: Dict, msg: Dict, hosted_content_id: str, chat_dir: str):
-    # it's happened in one case that a user doesn't have access to the hosted content
-    # in a chat they're a member of. not sure how that's possible, but that's why
-    # this check is here.
-    try:
-        result = (
-            await client.chats.by_chat_id(chat["id"])
-            .messages.by_chat_message_id(msg["id"])
-            .hosted_contents.by_chat_message_hosted_content_id(hosted_content_id)
-            .content.get()
-        )
-    except Exception as e:
-        result = str(e)
-    filename = get_hosted_content_filename(msg['id'], hosted_content_id)
-    path = os.path.join(chat_dir, filename)
-    with open(path, "wb") as f:
-        f.write(result)
-
-
-async def download_hosted_content_in_msg(client, chat: Dict, msg: Dict, chat_dir: str):
-    # fetch all the "hosted contents" (inline attachments)
+def get_hosted_content_ids(msg: Dict) -> List[str]:
+    """return the ids of all the "hosted contents" (inline attachments) referenced in a msg"""
+    hosted_content_ids = []
     for attachment in msg["attachments"]:
         if attachment["contentType"] == "application/vnd.microsoft.card.codesnippet":
-            hosted_content_id = get_hosted_content_id(attachment)
-            await download_hosted_content(client, chat, msg, hosted_content_id, chat_dir)
+            hosted_content_ids.append(get_hosted_content_id(attachment))
 
     # images are not present as attachments, just referenced in img tags
     content_type = (msg.get("body") or {}).get("contentType", "")
     content = (msg.get("body") or {}).get("content", "")
     if content_type == "html":
-        for match in re.findall('src="(.+?)"', content):
+        for match in src_re.findall(content):
             url = match
             if "https://graph.microsoft.com/v1.0/chats/" in url:
-                hosted_content_id = url.split("/")[-2]
-                await download_hosted_content(client, chat, msg, hosted_content_id, chat_dir)
+                hosted_content_ids.append(url.split("/")[-2])
+    return hosted_content_ids
+
+
+async def download_hosted_content_batch(client, chat: Dict, batch: List[Tuple[str, str]], chat_dir: str):
+    """
+    download up to batch_size_limit (msg_id, hosted_content_id) pairs in a single
+    request to the $batch endpoint. binary response bodies come back base64-encoded.
+    """
+    from kiota_abstractions.method import Method
+    from kiota_abstractions.request_information import RequestInformation
+
+    pending = dict(enumerate(batch))
+    for attempt in range(max_batch_attempts):
+        request_info = RequestInformation()
+        request_info.http_method = Method.POST
+        request_info.url = f"{client.request_adapter.base_url.rstrip('/')}/$batch"
+        request_info.headers.try_add("Content-Type", "application/json")
+        request_info.content = orjson.dumps({
+            "requests": [
+                {
+                    "id": str(i),
+                    "method": "GET",
+                    "url": f"/chats/{quote(chat['id'], safe='')}/messages/{quote(msg_id, safe='')}"
+                    f"/hostedContents/{quote(hosted_content_id, safe='')}/$value",
+                }
+                for i, (msg_id, hosted_content_id) in pending.items()
+            ]
+        })
+        try:
+            raw_response = await client.request_adapter.send_primitive_async(request_info, "bytes", {})
+        except Exception as e:
+            # if the batch request itself fails, save the error for each of its hosted contents,
+            # just like a failed individual request, rather than failing the whole chat
+            for msg_id, hosted_content_id in pending.values():
+                filename = get_hosted_content_filename(msg_id, hosted_content_id)
+                with open(os.path.join(chat_dir, filename), "wb") as f:
+                    f.write(str(e).encode("utf-8"))
+            return
+        response = orjson.loads(raw_response)
+        # the response holds every file in the batch; drop the raw copy before decoding
+        del raw_response
+
+        # individual requests in a batch aren't retried by the client's middleware,
+        # so throttled ones are re-sent in another batch
+        retry_after = 0
+        for item in response["responses"]:
+            i = int(item["id"])
+            if item["status"] == 429 and attempt < max_batch_attempts - 1:
+                retry_after = max(retry_after, int((item.get("headers") or {}).get("Retry-After", 1)))
+                continue
+
+            msg_id, hosted_content_id = pending.pop(i)
+            filename = get_hosted_content_filename(msg_id, hosted_content_id)
+            path = os.path.join(chat_dir, filename)
+            with open(path, "wb") as f:
+                if 200 <= item["status"] < 300:
+                    # decode in chunks so a file's decoded bytes aren't held in memory
+                    # alongside its base64 encoding. the parsed response still holds the
+                    # base64 of the whole batch; file sizes aren't known up front to cap it.
+                    body = item["body"]
+                    for start in range(0, len(body), base64_chunk_size):
+                        f.write(base64.b64decode(body[start:start + base64_chunk_size]))
+                else:
+                    # it's happened in one case that a user doesn't have access to the hosted content
+                    # in a chat they're a member of. not sure how that's possible, but that's why
+                    # the error is saved instead.
+                    f.write(orjson.dumps(item.get("body")))
+
+        if not pending:
+            break
+        await asyncio.sleep(retry_after)
+
 
+async def download_hosted_contents(client, chat: Dict, hosted_contents: List[Tuple[str, str]], chat_dir: str):
+    """download a list of (msg_id, hosted_content_id) pairs, batching the requests"""
+    await asyncio.gather(*(
+        download_hosted_content_batch(client, chat, hosted_contents[i:i + batch_size_limit], chat_dir)
+        for i in range(0, len(hosted_contents), batch_size_limit)
+    ))
 
-async def download_messages(client, chat: Dict, chat_dir: str, force: bool = False):
+
+async def download_messages(client, chat: Dict, chat_dir: str, conn: sqlite3.Connection, force: bool = False):
     """
-    download messages for a chat, including its 'hosted content'
+    download messages for a chat into its messages db, including its 'hosted content'
 
     Note that msg ids are not globally unique. They're millisecond timestamps.
 
     the 'force' flag downloads all messages that haven't been saved yet.
     by default, only newer messages are downloaded.
+
+    returns a dict of the msgs received whose saved copies match them, keyed by id,
+    so they can be rendered without reading them back from the db.
     """
+    from kiota_abstractions.native_response_handler import NativeResponseHandler
+    from kiota_http.middleware.options import ResponseHandlerOption
+    from msgraph.generated.chats.item.messages.messages_request_builder import MessagesRequestBuilder
+
+    # (msg_id, hosted_content_id) pairs waiting to be downloaded in a batch
+    hosted_contents = []
+    fetched_msgs = {}
 
     async def save_msg(msg):
-        with open(path, "w") as f:
-            f.write(json.dumps(msg))
-        await download_hosted_content_in_msg(client, chat, msg, chat_dir)
+        # save before get_hosted_content_ids() caches anything on the attachment records
+        save_msg_to_db(conn, msg)
+        fetched_msgs[msg["id"]] = msg
+        hosted_contents.extend((msg["id"], hosted_content_id) for hosted_content_id in get_hosted_content_ids(msg))
+        if len(hosted_contents) >= batch_size_limit:
+            await download_hosted_contents(client, chat, hosted_contents, chat_dir)
+            hosted_contents.clear()
 
     last_msg_id = (chat["lastMessagePreview"] or {}).get("id")
-    last_msg_exists = os.path.exists(os.path.join(chat_dir, f"msg_{last_msg_id}.json"))
+    last_msg_exists = conn.execute("SELECT 1 FROM msgs WHERE id = ?", (last_msg_id,)).fetchone() is not None
     if force or not last_msg_id or not last_msg_exists:
         count_saved = 0
         count_updated = 0
@@ -174,25 +347,27 @@ async def download_messages(client, chat: Dict, chat_dir: str, force: bool = Fal
         )
 
         async for msg in fetch_all_for_request(messages_request, request_config):
-            path = os.path.join(chat_dir, f"msg_{msg['id']}.json")
-            if not os.path.exists(path):
+            existing = conn.execute(
+                "SELECT last_modified, last_edited FROM msgs WHERE id = ?", (msg["id"],)
+            ).fetchone()
+            if not existing:
                 await save_msg(msg)
                 count_saved += 1
             else:
-                # if incoming msg was deleted, we don't want to overwrite our file
+                # if incoming msg was deleted, we don't want to overwrite our copy
                 if not msg["deletedDateTime"]:
-                    with open(path, "r") as f:
-                        existing_msg = json.loads(f.read())
+                    last_modified, last_edited = existing
 
                     # save edited/modified msgs
                     if (
-                        existing_msg["lastModifiedDateTime"] != msg["lastModifiedDateTime"]
-                        or existing_msg["lastEditedDateTime"] != msg["lastEditedDateTime"]
+                        last_modified != msg["lastModifiedDateTime"]
+                        or last_edited != msg["lastEditedDateTime"]
                     ):
                         await save_msg(msg)
                         count_updated += 1
                     else:
                         count_unchanged += 1
+                        fetched_msgs[msg["id"]] = msg
                         # msg exists but hasn't been edited/modified, so we can stop
                         # if we're not running in force mode
                         if not force:
@@ -200,31 +375,60 @@ async def download_messages(client, chat: Dict, chat_dir: str, force: bool = Fal
                 else:
                     count_unchanged += 1
 
-        output = f"  Message counts: {count_saved} saved, {count_updated} updated"
+        await download_hosted_contents(client, chat, hosted_contents, chat_dir)
+
+        output = f"  {get_chat_name(chat)}: {count_saved} saved, {count_updated} updated"
         if force:
             output += f", {count_unchanged} unchanged"
         print(output)
     else:
-        print("  No new messages in the chat since last run")
+        print(f"  {get_chat_name(chat)}: no new messages in the chat since last run")
+    return fetched_msgs
 
 
-async def download_chat(client, chat: Dict, data_dir: str, force: bool):
-    """download a single chat and its associated data (messages, attachments)"""
+async def download_chat(client, chat: Dict, data_dir: str, force: bool) -> Dict[str, Dict]:
+    """
+    download a single chat and its associated data (messages, attachments).
+    returns the msgs received, as returned by download_messages().
+    """
     print(f"Processing chat {get_chat_name(chat)} (id {chat['id']})")
 
     chat_dir = os.path.join(data_dir, chat["id"])
     makedir(chat_dir)
 
-    with open(os.path.join(data_dir, f"{chat['id']}.json"), "w") as f:
-        f.write(json.dumps(chat))
+    with open(os.path.join(data_dir, f"{chat['id']}.json"), "wb") as f:
+        f.write(orjson.dumps(chat))
+
+    # the connection's context manager commits all the msgs saved in one transaction
+    with closing(open_messages_db(chat_dir)) as conn, conn:
+        return await download_messages(client, chat, chat_dir, conn, force)
+
 
-    await download_messages(client, chat, chat_dir, force)
+async def download_all(output_dir: str, force: bool, render: bool = False) -> Dict[str, Dict]:
+    """
+    download all chats.
 
+    if render is True, each chat is also rendered to html right after it's downloaded,
+    using the msgs already in memory. chats with no new msgs are left for render_all. returns index
+    entries for the rendered chats, keyed by chat id.
+    """
+    from kiota_abstractions.native_response_handler import NativeResponseHandler
+    from kiota_http.middleware.options import ResponseHandlerOption
+    from msgraph.generated.chats.chats_request_builder import ChatsRequestBuilder
 
-async def download_all(output_dir: str, force: bool):
-    """download all chats"""
     data_dir = os.path.join(output_dir, "data")
     makedir(data_dir)
+    if render:
+        makedir(os.path.join(output_dir, "html"))
+
+    rendered = {}
+
+    async def process_chat(chat):
+        fetched_msgs = await download_chat(client, chat, data_dir, force)
+        if render and fetched_msgs:
+            # rendering is blocking, so keep it off the event loop
+            filename = await asyncio.to_thread(render_chat, chat, output_dir, fetched_msgs)
+            rendered[chat["id"]] = { "filename": filename, "chat_name": get_chat_name(chat) }
 
     client = get_graph_client()
 
@@ -237,69 +441,132 @@ async def download_all(output_dir: str, force: bool):
         options=[ResponseHandlerOption(NativeResponseHandler())],
         query_parameters=query_params,
     )
-    async for chat in fetch_all_for_request(client.me.chats, request_config):
-        await download_chat(client, chat, data_dir, force)
+    # pages of chats have to be fetched in sequence, but the chats themselves
+    # can be downloaded concurrently since the work is dominated by network round-trips
+    chats = [chat async for chat in fetch_all_for_request(client.me.chats, request_config)]
+
+    semaphore = asyncio.Semaphore(max_concurrent_downloads)
+
+    async def bounded(coro):
+        async with semaphore:
+            return await coro
 
+    await asyncio.gather(*(bounded(process_chat(chat)) for chat in chats))
 
-def render_hosted_content(msg: Dict, hosted_content_id: str, chat_dir: str):
-    filename = get_hosted_content_filename(msg['id'], hosted_content_id)
+    return rendered
+
+
+def read_hosted_content(msg_id: str, hosted_content_id: str, chat_dir: str) -> bytes:
+    filename = get_hosted_content_filename(msg_id, hosted_content_id)
     path = os.path.join(chat_dir, filename)
-    with open(path, "r") as f:
+    with open(path, "rb") as f:
         data = f.read()
     return data
 
 
-def render_message_body(msg: Dict, chat_dir: str, html_dir: str) -> Optional[str]:
-    """render a single message body, including its attachments"""
+def read_hosted_contents(msgs: List[Dict], chat_dir: str) -> Dict[Tuple[str, str], bytes]:
+    """
+    read all the hosted content files referenced by msgs, keyed by (msg_id, hosted_content_id)
+    like the files themselves. these are lots of small blocking reads, so they're overlapped
+    in a thread pool.
+
+    files that don't exist are left out. some referenced files are never rendered (e.g. an
+    attachment whose tag isn't in the body), so a missing file is only an error if the
+    rendering code goes to read it itself.
+    """
+
+    def read(ref):
+        try:
+            return read_hosted_content(ref[0], ref[1], chat_dir)
+        except FileNotFoundError:
+            return None
+
+    refs = list(dict.fromkeys(
+        (msg["id"], hosted_content_id) for msg in msgs for hosted_content_id in get_hosted_content_ids(msg)
+    ))
+    contents = get_read_executor().map(read, refs)
+    return {ref: content for ref, content in zip(refs, contents) if content is not None}
+
+
+def render_hosted_content(
+    msg: Dict, hosted_content_id: str, chat_dir: str, hosted_contents: Dict[Tuple[str, str], bytes]
+):
+    data = hosted_contents.pop((msg["id"], hosted_content_id), None)
+    if data is None:
+        data = read_hosted_content(msg["id"], hosted_content_id, chat_dir)
+    return data.decode("utf-8")
+
+
+def render_message_body(
+    msg: Dict, chat_dir: str, html_dir: str, hosted_contents: Dict[Tuple[str, str], bytes]
+) -> Optional[str]:
+    """
+    render a single message body, including its attachments
+
+    hosted_contents holds the hosted content files already read for the msg; entries
+    are removed as they're used.
+    """
 
     def get_attachment(match):
-        attachment_id = match.group(1)
-        attachment = [a for a in msg["attachments"] if a["id"] == attachment_id][0]
+        attachment_id = match.group("attachment_id")
+        attachment = attachments_by_id[attachment_id]
         if attachment["contentType"] == "reference":
             return f"Attachment: <a href='{attachment['contentUrl']}' data-attachment-id='{attachment['id']}'>{attachment['name']}</a><br/>"
         elif attachment["contentType"] == "messageReference":
-            ref = json.loads(attachment["content"])
+            ref = orjson.loads(attachment["content"])
             return f"<blockquote class='message-reference' data-attachment-id='{attachment['id']}'>{ref['messageSender']['user']['displayName']}: {ref['messagePreview']}</blockquote>"
         elif attachment["contentType"] == "application/vnd.microsoft.card.codesnippet":
             hosted_content_id = get_hosted_content_id(attachment)
-            content = render_hosted_content(msg, hosted_content_id, chat_dir)
+            content = render_hosted_content(msg, hosted_content_id, chat_dir, hosted_contents)
             return f"<div class='hosted-content' data-attachment-id='{attachment['id']}' data-hosted-content-id='{hosted_content_id}'><pre><code>{content}</code></pre></div>"
         else:
             return f"Attachment (raw data): {pprint.pformat(attachment)}<br/>"
 
     def get_image(match):
         whole_match = match.group(0)
-        url = match.group(1)
+        url = match.group("src")
         if "https://graph.microsoft.com/v1.0/chats/" in url:
             hosted_content_id = url.split("/")[-2]
-            filename = get_hosted_content_filename(msg['id'], hosted_content_id)
-            with open(os.path.join(chat_dir, filename), "rb") as f:
-                # TODO: not all images are actually png but this seems to work anyway
-                data = "data:image/png;base64," + base64.b64encode(f.read()).decode("utf-8")
-                return whole_match.replace(url, data) + f" data-hosted-content-id='{hosted_content_id}'"
+            # drop the raw bytes once they're encoded
+            content = hosted_contents.pop((msg["id"], hosted_content_id), None)
+            if content is None:
+                content = read_hosted_content(msg["id"], hosted_content_id, chat_dir)
+            # TODO: not all images are actually png but this seems to work anyway
+            data = "data:image/png;base64," + base64.b64encode(content).decode("utf-8")
+            return whole_match.replace(url, data) + f" data-hosted-content-id='{hosted_content_id}'"
         else:
             return whole_match
 
+    def replace_match(match):
+        if match.group("alt") is not None:
+            return match.group("alt")
+        elif match.group("attachment_id") is not None:
+            return get_attachment(match)
+        else:
+            return get_image(match)
+
     if msg["body"] and msg["body"]["content"]:
+        attachments_by_id = {a["id"]: a for a in msg.get("attachments") or []}
+
         v = msg["body"]["content"]
         if v:
             if v[0:3].lower() != "<p>":
                 v = f"<p>{v}</p>"
 
-            v = re.sub('<emoji.+?alt="(.+?)".+?></emoji>', r"\g<1>", v)
-
-            v = re.sub('<attachment id="(.+?)"></attachment>', get_attachment, v)
-
-            # loosey-goosey matching here :(
-            v = re.sub('src="(.+?)"', get_image, v)
+            # most msgs are plain text, and a substring check is much cheaper than a regex scan
+            if "<emoji" in v or "<attachment " in v or 'src="' in v:
+                v = message_body_re.sub(replace_match, v)
         return v
 
     return None
 
 
-def render_chat(chat: Dict, output_dir: str):
+def render_chat(chat: Dict, output_dir: str, fetched_msgs: Optional[Dict[str, Dict]] = None):
     """
     render a single chat to an html file. returns the name of the file rendered.
+
+    fetched_msgs = optional dict of msgs already in memory, keyed by id; these are
+        used as-is instead of being parsed again from the messages db
     """
 
     # read all the msgs for the chat, order them in chron order
@@ -307,12 +574,25 @@ def render_chat(chat: Dict, output_dir: str):
     html_dir = os.path.join(output_dir, "html")
     chat_dir = os.path.join(output_dir, "data", chat["id"])
 
-    messages_files = sorted(glob.glob(os.path.join(chat_dir, f"msg_*.json")))
+    with closing(open_messages_db(chat_dir)) as conn:
+        if fetched_msgs:
+            chat_msgs = [
+                fetched_msgs.get(msg_id) or orjson.loads(msg_json)
+                for (msg_id, msg_json) in conn.execute("SELECT id, json FROM msgs ORDER BY id")
+            ]
+        else:
+            chat_msgs = [orjson.loads(msg_json) for (msg_json,) in conn.execute("SELECT json FROM msgs ORDER BY id")]
+
+    # read each chunk's files up front so rendering the bodies is purely CPU work,
+    # while keeping only one chunk's worth of file contents in memory at a time
     msgs = []
-    for path in messages_files:
-        with open(path, "r") as f:
-            msg = json.loads(f.read())
-            msgs.append({"obj": msg, "content": render_message_body(msg, chat_dir, html_dir)})
+    for start in range(0, len(chat_msgs), render_chunk_size):
+        chunk = chat_msgs[start:start + render_chunk_size]
+        hosted_contents = read_hosted_contents(chunk, chat_dir)
+        msgs.extend(
+            {"obj": msg, "content": render_message_body(msg, chat_dir, html_dir, hosted_contents)}
+            for msg in chunk
+        )
 
     # write out the html file
 
@@ -322,34 +602,55 @@ def render_chat(chat: Dict, output_dir: str):
 
     with open(path, "w") as f:
         print(f"Writing {path}")
-        template = get_jinja_env().get_template("chat.jinja")
-        f.write(
-            template.render(
-                chat=chat,
-                member_list_str=get_member_list(chat),
-                messages=msgs,
-            )
-        )
+        template = get_chat_template()
+        # stream the output so the html for large chats isn't built up in memory
+        template.stream(
+            chat=chat,
+            member_list_str=get_member_list(chat),
+            messages=msgs,
+        ).dump(f)
     return filename
 
 
-def render_all(output_dir):
-    """render all the chats to html files"""
+def render_chat_file(path: str, output_dir: str) -> Dict:
+    """
+    render the chat stored in the json file at path. returns a dict entry for the index.
+
+    this runs in a worker process, so it only takes and returns picklable values.
+    """
+    with open(path, "rb") as f:
+        chat = orjson.loads(f.read())
+
+    filename = render_chat(chat, output_dir)
 
-    all_chats = []
+    chat_name = get_chat_name(chat)
 
-    makedir(os.path.join(output_dir, "html"))
+    return { "filename": filename, "chat_name": chat_name }
 
-    chat_files = sorted(glob.glob(os.path.join(output_dir, "data", "*.json")))
-    for path in chat_files:
-        with open(path, "r") as f:
-            chat = json.loads(f.read())
 
-            filename = render_chat(chat, output_dir)
+def render_all(output_dir, rendered: Optional[Dict[str, Dict]] = None):
+    """
+    render all the chats to html files
 
-            chat_name = get_chat_name(chat)
+    rendered = optional dict of index entries for chats that have already been
+        rendered, keyed by chat id. those chats are only added to the index.
+    """
+    rendered = rendered or {}
 
-            all_chats.append({ "filename": filename, "chat_name": chat_name })
+    makedir(os.path.join(output_dir, "html"))
+
+    # rendering is CPU-bound (json parsing, regexes, templates) and each chat
+    # is written to its own file, so chats are spread across processes
+    chat_files = sorted(
+        e.path
+        for e in os.scandir(os.path.join(output_dir, "data"))
+        if e.name.endswith(".json") and e.is_file() and e.name[:-len(".json")] not in rendered
+    )
+    # the read thread pool may already exist in this process (download_and_render), and a forked
+    # child would inherit it without its threads, so each child starts with a fresh one
+    with ProcessPoolExecutor(initializer=get_read_executor.cache_clear) as executor:
+        all_chats = list(executor.map(render_chat_file, chat_files, repeat(output_dir)))
+    all_chats.extend(rendered.values())
 
     all_chats = sorted(all_chats, key=lambda d: d['chat_name'])
 
@@ -357,15 +658,16 @@ def render_all(output_dir):
 
     with open(index_file, "w") as f:
         print(f"Writing {index_file}")
-        template = get_jinja_env().get_template("index.jinja")
-        f.write(
-            template.render(
-                chats=all_chats,
-            )
-        )
+        template = get_index_template()
+        template.stream(
+            chats=all_chats,
+        ).dump(f)
+
 
+def get_graph_client() -> "GraphServiceClient":
+    from azure.identity import InteractiveBrowserCredential
+    from msgraph import GraphServiceClient
 
-def get_graph_client() -> GraphServiceClient:
     if not client_id:
         print("Error: the CLIENT_ID environment variable isn't set")
         sys.exit(1)
@@ -378,7 +680,7 @@ def get_graph_client() -> GraphServiceClient:
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("command", choices=["download", "generate_html"])
+    parser.add_argument("command", choices=["download", "generate_html", "download_and_render"])
     parser.add_argument("--output-dir", type=str, default="archive")
     parser.add_argument("--force", help="download all msgs, not just 'newest' ones", action="store_true")
     args = parser.parse_args()
@@ -387,6 +689,9 @@ def main():
         asyncio.run(download_all(args.output_dir, args.force))
     elif args.command == "generate_html":
         render_all(args.output_dir)
+    elif args.command == "download_and_render":
+        rendered = asyncio.run(download_all(args.output_dir, args.force, render=True))
+        render_all(args.output_dir, rendered)
     else:
         print(f"Error: unrecognized command '{args.command}'")
 